@@ -14,7 +14,7 @@ Components:
 How to Use This Tutorial:
 
 Step 0: Prerequisites
-- Install PostgreSQL with pgvector extension:
+- Install PostgreSQL with pgvector extension (0.7.0 or later, for halfvec and binary quantization):
   - macOS: `brew install postgresql pgvector`
   - Ubuntu/Debian: `sudo apt install postgresql postgresql-contrib` then install pgvector
   - Windows: Download from https://www.postgresql.org/download/
@@ -62,9 +62,26 @@ Step 4: Run This Script
 """
 
 import os
+import asyncio
+import logging
+import re
+import multiprocessing
+import hashlib
+import shelve
+import numpy as np
 import psycopg
+from psycopg_pool import ConnectionPool
+from pgvector import HalfVector
+from pgvector.psycopg import register_vector
 import ollama
+import httpx
 import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+log = logging.getLogger(__name__)
 
 # Configuration
 DB_HOST = "localhost"
@@ -72,67 +89,429 @@ DB_PORT = "5432"
 DB_NAME = "rag_db"
 DB_USER = "rag_user"
 DB_PASSWORD = "password"
+POOL_MIN_SIZE = 2  # connections kept open in the pool
+POOL_MAX_SIZE = 10  # upper bound on concurrent connections
 OLLAMA_HOST = "http://localhost:11434"
 GENERATION_MODEL = "gemma3:270m"
+MODEL_KEEP_ALIVE = "10m"  # keep models loaded in Ollama between requests
+GENERATION_OPTIONS = {"num_ctx": 2048, "num_batch": 512}  # context window and prompt-eval batch size
+ANSWER_CACHE_SIZE = 1024  # generated answers remembered per process
+# Generated answers, keyed by the retrieved document ids and the normalized
+# query, kept in least-recently-used order. Queries can run concurrently on
+# the connection pool, so all access goes through the lock.
+answer_cache = OrderedDict()
+answer_cache_lock = threading.Lock()
+SYSTEM_PROMPT = "Based on the provided context, answer the question clearly and helpfully. Use only information from the context."
 EMBEDDING_MODEL = "nomic-embed-text"
+EMBED_MAX_WORKERS = 4  # concurrent requests when falling back to per-prompt embeddings
+EMBEDDING_CACHE_PATH = ".emb_cache"  # on-disk cache of chunk embeddings
 VECTOR_DIMENSION = 768  # nomic-embed-text model dimension
+MIN_PGVECTOR_VERSION = (0, 7, 0)  # first pgvector release with halfvec and binary_quantize
+INGEST_BATCH_SIZE = 64  # chunks embedded and inserted together
+INGEST_PIPELINE_DEPTH = 2  # embedded batches allowed to wait for insertion
+PARALLEL_SPLIT_MIN_DOCUMENTS = 64  # split documents in worker processes above this count
+HNSW_M = 16  # max connections per node in the HNSW graph
+HNSW_EF_CONSTRUCTION = 64  # candidate list size while building the index
+HNSW_EF_SEARCH = 200  # candidate list size at query time (recall vs. latency)
+# Binary-quantized matches re-ranked with full-precision distance. An HNSW scan
+# returns at most ef_search rows, so this is the same as HNSW_EF_SEARCH.
+RERANK_CANDIDATES = HNSW_EF_SEARCH
+
+# Sentence boundary: whitespace following '.', '!' or '?'. Unlike a plain
+# split('.'), this keeps decimals such as "11.5" inside their sentence.
+# Whitespace after one of the common abbreviations below is not a boundary,
+# so "Dr. Smith" stays together; other abbreviations still end a chunk.
+SENTENCE_ABBREVIATIONS = ("Dr", "Mr", "Mrs", "Ms", "Prof", "St", "Jr", "Sr", "vs", "e.g", "i.e")
+SENTENCE_BOUNDARY = re.compile(
+    r'(?<=[.!?])'
+    + "".join(rf'(?<!\b{re.escape(abbreviation)}\.)' for abbreviation in SENTENCE_ABBREVIATIONS)
+    + r'\s+'
+)
+
+# --- Helper: Split documents into sentence chunks ---
+def split_into_chunks(document):
+    """
+    Splits a document into sentence-sized chunks for the RAG system.
+    """
+    return [chunk.strip() for chunk in SENTENCE_BOUNDARY.split(document) if chunk.strip()]
+
+def split_documents(documents):
+    """
+    Splits a list of documents into chunks. Each document is independent,
+    so large corpora are split across worker processes. Chunks are returned
+    in document order either way, so ingestion is the same on every run.
+    """
+    if len(documents) < PARALLEL_SPLIT_MIN_DOCUMENTS:
+        return [chunk for document in documents for chunk in split_into_chunks(document)]
+    
+    with multiprocessing.Pool() as workers:
+        return [
+            chunk
+            for chunks in workers.imap(split_into_chunks, documents, chunksize=16)
+            for chunk in chunks
+        ]
+
+# --- Helper: Create an Ollama client with a keep-alive connection pool ---
+def create_ollama_client():
+    """
+    Creates an Ollama client whose underlying httpx connection pool keeps
+    connections alive, so repeated requests reuse the same sockets.
+    """
+    return ollama.Client(
+        host=OLLAMA_HOST,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=30),
+        timeout=httpx.Timeout(300, connect=10)
+    )
+
+# --- Helper: Request embeddings for a batch of texts from Ollama ---
+def fetch_embeddings(client, texts):
+    """
+    Generates embeddings for a list of texts in a single request using
+    Ollama's batch `/api/embed` endpoint, instead of one HTTP call per text.
+    Falls back to the older per-prompt `/api/embeddings` endpoint if the
+    batch endpoint is unavailable. The embeddings are returned as the rows of
+    a contiguous float32 array, and are unit length.
+    """
+    try:
+        response = client.embed(model=EMBEDDING_MODEL, input=texts, keep_alive=MODEL_KEEP_ALIVE)
+        embeddings = response['embeddings']
+    except ollama.ResponseError as e:
+        if e.status_code != 404:
+            raise
+        # Older Ollama servers don't have `/api/embed` and only support one
+        # prompt per request, so issue those requests concurrently over the
+        # pooled client and normalize them like `/api/embed` does
+        def embed_one(text):
+            embedding = np.asarray(
+                client.embeddings(model=EMBEDDING_MODEL, prompt=text, keep_alive=MODEL_KEEP_ALIVE)['embedding'],
+                dtype=np.float32
+            )
+            return embedding / np.linalg.norm(embedding)
+        
+        with ThreadPoolExecutor(max_workers=EMBED_MAX_WORKERS) as executor:
+            embeddings = list(executor.map(embed_one, texts))
+    
+    # Convert at the boundary so the rest of the pipeline (cache, binary COPY,
+    # pgvector adapter) works on packed float32 buffers instead of Python floats
+    return np.asarray(embeddings, dtype=np.float32)
+
+# --- Helper: Load the models before they are first needed ---
+def warm_up_models(client):
+    """
+    Sends tiny requests to both models so Ollama loads them into memory up
+    front, instead of folding the model load time into the first real request.
+    """
+    fetch_embeddings(client, ["warmup"])
+    # An empty prompt only loads the generation model
+    client.generate(
+        model=GENERATION_MODEL,
+        prompt="",
+        # Same runner options as run_rag_query, otherwise Ollama reloads the
+        # model for the first real query
+        options={**GENERATION_OPTIONS, "num_predict": 1},
+        keep_alive=MODEL_KEEP_ALIVE
+    )
+
+# --- Helper: Generate embeddings, reusing cached ones when possible ---
+def embed_texts(client, texts):
+    """
+    Returns embeddings for a list of texts. Embeddings are cached on disk,
+    keyed by a hash of the model name and text, so re-running the ingestion
+    only sends new or changed texts to Ollama.
+    """
+    keys = [
+        hashlib.sha256((EMBEDDING_MODEL + "|" + text).encode()).hexdigest()
+        for text in texts
+    ]
+    
+    with shelve.open(EMBEDDING_CACHE_PATH) as cache:
+        missing = [(key, text) for key, text in zip(keys, texts) if key not in cache]
+        if missing:
+            log.debug("Cache miss for %d of %d texts, requesting embeddings from Ollama", len(missing), len(texts))
+            new_embeddings = fetch_embeddings(client, [text for _, text in missing])
+            for (key, _), embedding in zip(missing, new_embeddings):
+                cache[key] = embedding
+        else:
+            log.debug("All %d embeddings found in cache", len(texts))
+        
+        return [np.asarray(cache[key], dtype=np.float32) for key in keys]
+
+# --- Helper: Prepare each new pooled connection ---
+def configure_connection(conn):
+    """
+    Registers pgvector's adapters on a new connection so embeddings are
+    sent in binary vector format.
+    """
+    try:
+        register_vector(conn)
+    except psycopg.ProgrammingError:
+        # The vector type doesn't exist yet; setup_database reports this
+        pass
+
+# --- Helper: Retrieve documents for a batch of queries ---
+def retrieve_documents_batch(pool, query_embeddings):
+    """
+    Retrieves the 3 most relevant documents for each of several query
+    embeddings in a single statement, instead of one round trip per query.
+    Returns one list of (id, content) rows per query, in the same order as
+    the queries.
+    """
+    # unnest() turns the array of query vectors into rows, and the LATERAL
+    # subquery searches the documents for each row in two stages:
+    # 1. The `<~>` operator performs Hamming distance search on the
+    #    binary-quantized embeddings, using the HNSW index to find candidates.
+    #    The ORDER BY matches the indexed expression exactly so the planner
+    #    can use the index instead of a sequential scan.
+    # 2. The `<->` operator re-ranks those candidates by L2 distance on the
+    #    full vectors, which for unit-length embeddings gives the same
+    #    ranking as cosine distance.
+    # ef_search sets how many candidates the HNSW scan returns.
+    # SET LOCAL only lasts for the current transaction.
+    with pool.connection() as conn, conn.transaction(), conn.cursor() as cur:
+        cur.execute(f"SET LOCAL hnsw.ef_search = {HNSW_EF_SEARCH};")
+        
+        # The embeddings are float32 arrays; the pgvector adapter sends them
+        # in binary, so no text literal needs to be parsed. They are converted
+        # to halfvec on the server to match the stored embeddings.
+        # prepare=True makes this a server-side prepared statement, so each
+        # pooled connection parses and plans it once and reuses the plan.
+        cur.execute(f"""
+            SELECT
+                q.qid, d.id, d.content
+            FROM
+                unnest(%s::halfvec[]) WITH ORDINALITY AS q(vec, qid)
+            CROSS JOIN LATERAL (
+                SELECT
+                    c.id, c.content, c.embedding <-> q.vec AS distance
+                FROM (
+                    SELECT
+                        id, content, embedding
+                    FROM
+                        documents
+                    ORDER BY
+                        binary_quantize(embedding)::bit({VECTOR_DIMENSION}) <~> binary_quantize(q.vec)
+                    LIMIT {RERANK_CANDIDATES}
+                ) AS c
+                ORDER BY
+                    distance
+                LIMIT 3
+            ) AS d
+            ORDER BY
+                q.qid, d.distance;
+        """, (list(query_embeddings),), prepare=True)
+        
+        results = [[] for _ in query_embeddings]
+        for qid, doc_id, content in cur.fetchall():
+            results[qid - 1].append((doc_id, content))
+    
+    return results
 
 # --- Step 1: Connect to the database and ensure the table exists ---
 def setup_database():
     """
-    Connects to the PostgreSQL database, creates the vector extension,
-    and sets up the 'documents' table if it doesn't exist.
+    Opens a connection pool to the PostgreSQL database, checks for the vector
+    extension, and sets up the 'documents' table if it doesn't exist.
     """
-    conn = None
+    pool = None
     try:
         print("\n--- Connecting to PostgreSQL database ---")
-        conn = psycopg.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            autocommit=True,
-            gssencmode="disable"
+        pool = ConnectionPool(
+            conninfo="",
+            kwargs={
+                "host": DB_HOST,
+                "port": DB_PORT,
+                "dbname": DB_NAME,
+                "user": DB_USER,
+                "password": DB_PASSWORD,
+                "autocommit": True,
+                "gssencmode": "disable"
+            },
+            min_size=POOL_MIN_SIZE,
+            max_size=POOL_MAX_SIZE,
+            configure=configure_connection,
+            open=True
         )
+        # Fail fast if the pool can't establish its initial connections
+        pool.wait()
         print("Connection successful!")
         
-        with conn.cursor() as cur:
-            # Check if the 'vector' extension is installed
-            cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'vector';")
-            if cur.fetchone() is None:
-                print("pgvector extension not found. Please ensure your Docker image supports it.")
-                print("This script uses the 'ankane/pgvector' Docker image which has it pre-installed.")
-                print("If you're running a different PostgreSQL image, you may need to install it manually.")
-                return None
-            else:
-                print("pgvector extension is installed.")
-
-            # Drop the table if it already exists to start fresh
-            cur.execute("DROP TABLE IF EXISTS documents;")
+        with pool.connection() as conn, conn.cursor() as cur:
+            # Check if the 'vector' extension is installed, and which version
+            cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector';")
+            row = cur.fetchone()
+        
+        if row is None:
+            print("pgvector extension not found. Please ensure your Docker image supports it.")
+            print("This script uses the 'ankane/pgvector' Docker image which has it pre-installed.")
+            print("If you're running a different PostgreSQL image, you may need to install it manually.")
+            pool.close()
+            return None
+        elif tuple(int(part) for part in row[0].split(".")) < MIN_PGVECTOR_VERSION:
+            # Checked before touching the table, so an existing one isn't dropped
+            # only for the new one to fail on the missing halfvec type
+            required = ".".join(map(str, MIN_PGVECTOR_VERSION))
+            print(f"pgvector extension {row[0]} is installed, but this script needs {required} or later.")
+            print(f"The halfvec type and binary_quantize() used here were added in pgvector {required}.")
+            print("Please upgrade pgvector, then run `ALTER EXTENSION vector UPDATE;` in the database.")
+            pool.close()
+            return None
+        else:
+            print(f"pgvector extension {row[0]} is installed.")
+        
+        # Run the layout check, drop and create in one transaction, so a
+        # failure leaves any existing table untouched
+        with pool.connection() as conn, conn.transaction(), conn.cursor() as cur:
+            # The table is kept between runs, but a 'documents' table created by
+            # the notebook or an older version of this script has different
+            # columns or stores embeddings as VECTOR instead of HALFVEC.
+            # Recreate it in that case; the embeddings are cached on disk,
+            # so re-ingesting is cheap.
+            cur.execute("""
+                SELECT attname, format_type(atttypid, atttypmod)
+                FROM pg_attribute
+                WHERE attrelid = to_regclass('documents') AND attnum > 0 AND NOT attisdropped;
+            """)
+            existing_columns = dict(cur.fetchall())
+            expected_columns = {
+                "id": "integer",
+                "content_hash": "bytea",
+                "content": "text",
+                "embedding": f"halfvec({VECTOR_DIMENSION})"
+            }
+            if existing_columns and existing_columns != expected_columns:
+                print("Existing 'documents' table has an outdated layout, recreating it.")
+                cur.execute("DROP TABLE documents;")
             
-            # Create the documents table with a vector column
+            # Create the documents table with a vector column. The table is kept
+            # between runs; content_hash lets re-ingestion skip existing chunks.
+            # Embeddings are stored as half-precision (FP16) vectors, which
+            # halves the table size and the memory read per distance calculation.
             cur.execute(f"""
-                CREATE TABLE documents (
+                CREATE TABLE IF NOT EXISTS documents (
                     id SERIAL PRIMARY KEY,
+                    content_hash BYTEA UNIQUE,
                     content TEXT,
-                    embedding VECTOR({VECTOR_DIMENSION})
+                    embedding HALFVEC({VECTOR_DIMENSION})
                 );
             """)
-            print(f"Table 'documents' created successfully with a VECTOR({VECTOR_DIMENSION}) column.")
+            print(f"Table 'documents' is ready with a HALFVEC({VECTOR_DIMENSION}) column.")
         
-        return conn
+        return pool
 
     except psycopg.OperationalError as e:
         print(f"\nError: Could not connect to PostgreSQL. Please ensure the Docker container is running and accessible.")
         print(f"Details: {e}")
+        if pool is not None:
+            pool.close()
         return None
+    except psycopg.Error as e:
+        print(f"\nError: Could not set up the 'documents' table.")
+        print(f"Details: {e}")
+        if pool is not None:
+            pool.close()
+        return None
+
+# --- Helper: Insert a batch of embedded chunks ---
+def insert_batch(pool, rows, embeddings):
+    """
+    Inserts a batch of (content_hash, content) rows and their embeddings,
+    skipping chunks that are already stored. Returns the number of rows inserted.
+    """
+    with pool.connection() as conn, conn.transaction(), conn.cursor() as cur:
+        # COPY can't resolve conflicts itself, so stream the rows
+        # into a temporary staging table in a single binary COPY,
+        # then upsert them, skipping hashes that are already stored
+        cur.execute(f"""
+            CREATE TEMP TABLE documents_staging (
+                content_hash BYTEA,
+                content TEXT,
+                embedding HALFVEC({VECTOR_DIMENSION})
+            ) ON COMMIT DROP;
+        """)
+        with cur.copy("COPY documents_staging (content_hash, content, embedding) FROM STDIN WITH (FORMAT BINARY)") as copy:
+            copy.set_types(['bytea', 'text', 'halfvec'])
+            # Per-chunk details are logged at DEBUG level, off by default,
+            # so large ingests aren't slowed down by console output.
+            # pgvector's halfvec dumper only accepts HalfVector values, which
+            # also converts the float32 embedding to FP16 before sending it.
+            for (h, chunk), embedding in zip(rows, embeddings):
+                log.debug("Processing chunk: '%s...'", chunk[:50])
+                copy.write_row((h, chunk, HalfVector(embedding)))
+        cur.execute("""
+            INSERT INTO documents (content_hash, content, embedding)
+            SELECT content_hash, content, embedding FROM documents_staging
+            ON CONFLICT (content_hash) DO NOTHING;
+        """)
+        return cur.rowcount
+
+# --- Helper: Embed and insert chunks in an overlapping pipeline ---
+async def ingest_pipeline(pool, client, rows):
+    """
+    Embeds and inserts (content_hash, content) rows in batches. Embedding is
+    compute-bound in Ollama while inserting waits on PostgreSQL, so the next
+    batch is embedded while the previous one is being written.
+    Returns the number of rows inserted.
+    """
+    queue = asyncio.Queue(maxsize=INGEST_PIPELINE_DEPTH)
+    
+    async def produce():
+        for start in range(0, len(rows), INGEST_BATCH_SIZE):
+            batch = rows[start:start + INGEST_BATCH_SIZE]
+            # The Ollama and PostgreSQL clients are blocking, so each stage
+            # runs in a worker thread and the event loop coordinates them
+            embeddings = await asyncio.to_thread(embed_texts, client, [chunk for _, chunk in batch])
+            await queue.put((batch, embeddings))
+        await queue.put(None)
+    
+    async def consume():
+        inserted = 0
+        with tqdm(total=len(rows), desc="Inserting chunks") as progress:
+            while (item := await queue.get()) is not None:
+                batch, embeddings = item
+                inserted += await asyncio.to_thread(insert_batch, pool, batch, embeddings)
+                progress.update(len(batch))
+        return inserted
+    
+    _, inserted = await asyncio.gather(produce(), consume())
+    return inserted
+
+# --- Helper: Find chunks that are already stored ---
+def find_existing_hashes(pool, hashes):
+    """
+    Returns the subset of the given content hashes already in the 'documents' table.
+    """
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT content_hash FROM documents WHERE content_hash = ANY(%s);",
+            (hashes,)
+        )
+        return {bytes(row[0]) for row in cur.fetchall()}
+
+# --- Helper: Build the vector index ---
+def create_vector_index(pool):
+    """
+    Creates the HNSW index on the binary-quantized embeddings if it doesn't exist.
+    """
+    with pool.connection() as conn, conn.cursor() as cur:
+        # Build the HNSW index after the first bulk load, which is much
+        # faster than maintaining it row by row during the inserts.
+        # The index is built over binary-quantized embeddings (one bit
+        # per dimension, compared by Hamming distance), which is far
+        # smaller and cheaper to search than the float vectors.
+        cur.execute(f"""
+            CREATE INDEX IF NOT EXISTS documents_embedding_bits_hnsw
+            ON documents USING hnsw ((binary_quantize(embedding)::bit({VECTOR_DIMENSION})) bit_hamming_ops)
+            WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION});
+        """)
 
 # --- Step 2: Ingest Sample Data and Create Embeddings ---
-def ingest_data(conn):
+async def ingest_data(pool, client):
     """
-    Loads a sample text, splits it into chunks, generates embeddings for each chunk,
-    and inserts the data into the PostgreSQL table.
+    Loads a sample text, splits it into chunks, generates embeddings for each new chunk,
+    and inserts the data into the PostgreSQL table. Chunks already in the table are skipped.
+    This is a coroutine so it can run inside an existing event loop (for example
+    `await ingest_data(pool, client)` in Jupyter); from a script use asyncio.run().
+    The blocking database and Ollama calls run in worker threads.
     """
     print("\n--- Ingesting sample data and creating embeddings ---")
     
@@ -146,44 +525,48 @@ def ingest_data(conn):
     """
     
     # Split the document into chunks for the RAG system.
-    # A simple split by sentence or a fixed number of words works well for a tutorial.
-    chunks = document.split('.')
-    chunks = [chunk.strip() for chunk in chunks if chunk.strip()]
+    # Splitting by sentence works well for a tutorial.
+    chunks = split_documents([document])
+    
+    # Hash each chunk so chunks that are already stored can be skipped
+    hashes = {hashlib.sha256(chunk.encode()).digest(): chunk for chunk in chunks}
+    
+    try:
+        existing = await asyncio.to_thread(find_existing_hashes, pool, list(hashes))
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        return False
     
-    # Create the Ollama client
-    client = ollama.Client(host=OLLAMA_HOST)
+    new_rows = [(h, chunk) for h, chunk in hashes.items() if h not in existing]
+    print(f"{len(existing)} chunks already stored, {len(new_rows)} new chunks to ingest.")
     
-    with conn.cursor() as cur:
-        for chunk in chunks:
-            print(f"Processing chunk: '{chunk[:50]}...'")
-            try:
-                # Generate embedding for the chunk using the local embedding model
-                embedding_response = client.embeddings(
-                    model=EMBEDDING_MODEL,
-                    prompt=chunk
-                )
-                embedding = embedding_response['embedding']
-                
-                # Insert the chunk and its embedding into the database
-                cur.execute(
-                    "INSERT INTO documents (content, embedding) VALUES (%s, %s);",
-                    (chunk, embedding)
-                )
-                print(f"Inserted chunk into database. Vector dimension: {len(embedding)}")
-                
-            except (ollama.RequestError, ollama.ResponseError) as e:
-                print(f"\nError: Could not connect to Ollama. Please ensure the Docker container is running and the model is pulled.")
-                print(f"Details: {e}")
-                return False
-            except Exception as e:
-                print(f"An unexpected error occurred: {e}")
-                return False
+    try:
+        # Load both models now so neither ingestion nor the first
+        # query pays the model load time
+        print("Loading models in Ollama...")
+        await asyncio.to_thread(warm_up_models, client)
+        
+        if new_rows:
+            print(f"Generating embeddings and inserting {len(new_rows)} chunks in batches of {INGEST_BATCH_SIZE}...")
+            inserted = await ingest_pipeline(pool, client, new_rows)
+            print(f"Inserted {inserted} chunks into database. Vector dimension: {VECTOR_DIMENSION}")
+        
+        await asyncio.to_thread(create_vector_index, pool)
+        print("HNSW index is ready on the binary-quantized 'documents.embedding'.")
+        
+    except (ollama.RequestError, ollama.ResponseError) as e:
+        print(f"\nError: Could not connect to Ollama. Please ensure the Docker container is running and the model is pulled.")
+        print(f"Details: {e}")
+        return False
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        return False
     
     print("\nData ingestion complete.")
     return True
 
 # --- Step 3: Perform a Retrieval-Augmented Generation Query ---
-def run_rag_query(conn, user_query):
+def run_rag_query(pool, client, user_query):
     """
     Performs the full RAG process:
     1. Generates an embedding for the user's query.
@@ -192,50 +575,60 @@ def run_rag_query(conn, user_query):
     """
     print(f"\n--- Processing user query: '{user_query}' ---")
     
-    client = ollama.Client(host=OLLAMA_HOST)
-    
     try:
         # Generate embedding for the user query
-        query_embedding_response = client.embeddings(
-            model=EMBEDDING_MODEL,
-            prompt=user_query
-        )
-        query_embedding = query_embedding_response['embedding']
+        # (unit length, like the stored chunk embeddings)
+        query_embedding = fetch_embeddings(client, [user_query])[0]
         
-        # Use psycopg to query the database for the most similar documents
-        # The `<=>` operator performs cosine distance search on vectors.
-        with conn.cursor() as cur:
-            # Convert the embedding list to a PostgreSQL vector string
-            vector_str = '[' + ','.join(map(str, query_embedding)) + ']'
-            cur.execute(f"""
-                SELECT
-                    content
-                FROM
-                    documents
-                ORDER BY
-                    embedding <=> %s::vector
-                LIMIT 3;
-            """, (vector_str,))
-            
-            # Fetch the results
-            retrieved_docs = [row[0] for row in cur.fetchall()]
+        # Use psycopg to query the database for the most similar documents,
+        # through the same search that serves batches of queries
+        rows = retrieve_documents_batch(pool, [query_embedding])[0]
+        retrieved_ids = [row[0] for row in rows]
+        retrieved_docs = [row[1] for row in rows]
             
         print("\n--- Retrieved the following relevant chunks from the database ---")
         for i, doc in enumerate(retrieved_docs):
             print(f"Chunk {i+1}: {doc}")
-            
-        # Create a context string from the retrieved documents
-        context = " ".join(retrieved_docs)
         
-        # Construct the final prompt for the LLM
-        prompt = f"Based on the provided context, answer the question clearly and helpfully. Use only information from the context.\n\nContext: {context}\n\nQuestion: {user_query}\n\nAnswer:"
+        # Reuse the answer if the same question was already answered from the
+        # same retrieved chunks, skipping generation entirely
+        normalized_query = " ".join(user_query.lower().split())
+        cache_key = (
+            tuple(sorted(retrieved_ids)),
+            hashlib.sha256(normalized_query.encode()).hexdigest()
+        )
+        with answer_cache_lock:
+            full_response = answer_cache.get(cache_key)
+            if full_response is not None:
+                answer_cache.move_to_end(cache_key)
+        if full_response is not None:
+            print("\n--- Reusing cached response ---")
+            print(f"Response:\n{full_response}")
+            print("\n\n--- RAG process complete ---")
+            return full_response
+            
+        # Construct the final prompt for the LLM. The instructions are sent
+        # separately as a fixed system prompt, so every query starts with the
+        # same prefix and Ollama can reuse its cached prefill for it.
+        # The prompt is assembled from a list of parts and joined once, so the
+        # retrieved documents are copied a single time into the final string.
+        parts = ["Context: "]
+        for i, doc in enumerate(retrieved_docs):
+            if i:
+                parts.append(" ")
+            parts.append(doc)
+        parts.extend(["\n\nQuestion: ", user_query, "\n\nAnswer:"])
+        prompt = "".join(parts)
         
         # Generate the final response using the Gemma model
         print("\n--- Generating response with Gemma 3:270M ---")
         stream = client.generate(
             model=GENERATION_MODEL,
+            system=SYSTEM_PROMPT,
             prompt=prompt,
-            stream=True
+            stream=True,
+            keep_alive=MODEL_KEEP_ALIVE,
+            options=GENERATION_OPTIONS
         )
         
         full_response = ""
@@ -244,6 +637,11 @@ def run_rag_query(conn, user_query):
             response_text = chunk['response']
             full_response += response_text
             print(response_text, end='', flush=True)
+        
+        with answer_cache_lock:
+            answer_cache[cache_key] = full_response
+            if len(answer_cache) > ANSWER_CACHE_SIZE:
+                answer_cache.popitem(last=False)
             
         print("\n\n--- RAG process complete ---")
         return full_response
@@ -262,14 +660,19 @@ def main():
     print("This script will demonstrate how to build a RAG system using local tools.")
     
     # 1. Database Setup
-    conn = setup_database()
-    if conn is None:
+    pool = setup_database()
+    if pool is None:
         return
+    
+    # One Ollama client is shared by ingestion and queries, so its
+    # keep-alive connections are reused for every request
+    client = create_ollama_client()
         
     # 2. Data Ingestion
-    ingestion_success = ingest_data(conn)
+    ingestion_success = asyncio.run(ingest_data(pool, client))
     if not ingestion_success:
-        conn.close()
+        client.close()
+        pool.close()
         return
 
     # Give the user a moment to see the output
@@ -277,9 +680,10 @@ def main():
     
     # 3. RAG Query
     user_question = "What makes a llama a good companion?"
-    run_rag_query(conn, user_question)
+    run_rag_query(pool, client, user_question)
     
-    conn.close()
+    client.close()
+    pool.close()
     
 if __name__ == "__main__":
     main()